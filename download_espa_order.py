@@ -8,6 +8,8 @@ Requires: Standard Python installation. (can also use requests)
 
 Changes:
 
+15 October 2026: Download several scenes at the same time (new --concurrency option)
+                 and split large files into concurrent byte ranges (new --segments option)
 23 May 2018: Adam J. Stewart suggestion/adds new CLI options for retries and directory control
 31 Jan 2017: Updated HTTPS support for python 2.7 series (allow using requests library)
 20 June 2017: Woodstonelee added option to download checksum and error handling on bad urls
@@ -20,6 +22,7 @@ Changes:
 """
 import argparse
 import base64
+import errno
 import os
 import random
 import shutil
@@ -29,24 +32,240 @@ import time
 import json
 import hashlib
 import logging
+import threading
 from getpass import getpass
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 if sys.version_info[0] == 3:
+    import queue
     import urllib.request as ul
+    from urllib.parse import urlsplit
 else:
+    import Queue as queue
     import urllib2 as ul
+    from urlparse import urlsplit
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     logging.getLogger("urllib3").setLevel(logging.WARNING)
 except ImportError:
     requests = None
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 __version__ = '2.2.5'
 LOGGER = logging.getLogger(__name__)
 USERAGENT = ('EspaBulkDownloader/{v} ({s}) Python/{p}'
              .format(v=__version__, s=platform.platform(aliased=True),
                      p=platform.python_version()))
+# Seconds to wait for a connection, then between bytes read from it, so a
+# stalled socket fails (and is retried) instead of holding a worker forever
+TIMEOUT = (15, 60)
+# Files smaller than two of these are never split into ranged segments
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+# Seconds between saves of a segment manifest while its ranges download
+MANIFEST_SAVE_INTERVAL = 2
+# Bytes read from the network per copy, sized for long fat links
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+# Most order status requests sent to the API at the same time
+METADATA_CONCURRENCY = 16
+# Upper bound on the size of a checksum file, fetched in a single request
+CHECKSUM_MAX_BYTES = 1024
+# Seconds to wait before retrying a failed download, doubling per attempt
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+
+def backoff_delay(attempt):
+    """ Exponential backoff with jitter for the given (zero-based) retry attempt """
+    return min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) + random.uniform(0, BACKOFF_BASE)
+
+
+def fadvise(fd, advice):
+    """ Give the kernel a page cache hint such as 'POSIX_FADV_DONTNEED' for a whole file """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def drop_page_cache(path):
+    """ Let the kernel evict a finished file which this process will not read again """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        # Dirty pages are not evicted, so write them out first
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        fadvise(fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(fd)
+
+
+def new_md5():
+    """ MD5 hasher flagged as not used for security, which FIPS-mode OpenSSL requires """
+    try:
+        return hashlib.new('md5', usedforsecurity=False)
+    except TypeError:
+        # Python < 3.9
+        return hashlib.md5()
+
+
+def hash_file(path, hasher=None, length=None, offset=0):
+    """
+    Feed a file to hasher (a new MD5 by default) in 1 MiB blocks rather than all at once
+
+    args:
+        path - file to read
+        hasher - hashlib-style object to update
+        length - only hash this many bytes of the file
+        offset - where in the file to start
+
+    returns:
+        the updated hasher
+    """
+    with open(path, 'rb') as f:
+        fadvise(f.fileno(), 'POSIX_FADV_SEQUENTIAL')
+        f.seek(offset)
+        if hasher is None and length is None and hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, new_md5)
+        if hasher is None:
+            hasher = new_md5()
+        while length is None or length > 0:
+            block = f.read(1024 * 1024 if length is None else min(1024 * 1024, length))
+            if not block:
+                break
+            hasher.update(block)
+            if length is not None:
+                length -= len(block)
+    return hasher
+
+
+def copy_bytes(source, target, length, bufsize):
+    """ Like shutil.copyfileobj, but stops after length bytes """
+    while length > 0:
+        block = source.read(min(bufsize, length))
+        if not block:
+            break
+        target.write(block)
+        length -= len(block)
+
+
+def content_size(response, first_byte=0):
+    """ Total size of the file behind a (possibly ranged) response, or None if not given """
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('*'):
+        return int(content_range.rsplit('/', 1)[-1])
+    if 'Content-Length' in response.headers:
+        size = int(response.headers['Content-Length'])
+        return size + first_byte if response.status_code == 206 else size
+    return None
+
+
+class DownloadCancelled(Exception):
+    """ The run was interrupted while a file was being written """
+
+
+class HashingWriter(object):
+    """ File-like wrapper which hashes everything written through it, and stops once cancelled """
+    def __init__(self, target, hasher=None, cancelled=None):
+        self.target = target
+        self.hasher = hasher
+        self.cancelled = cancelled
+
+    def write(self, block):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise DownloadCancelled()
+        if self.hasher is not None:
+            self.hasher.update(block)
+        return self.target.write(block)
+
+
+class SegmentWriter(object):
+    """ File-like writer placing blocks at the next offset of one manifest segment """
+    def __init__(self, fd, manifest, index, hasher=None, cancelled=None):
+        self.fd = fd
+        self.manifest = manifest
+        self.index = index
+        self.hasher = hasher
+        self.cancelled = cancelled
+
+    def write(self, block):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise DownloadCancelled()
+        if self.hasher is not None:
+            self.hasher.update(block)
+        offset = self.manifest.segments[self.index][1]
+        view = memoryview(block)
+        while len(view):
+            written = os.pwrite(self.fd, view, offset)
+            offset += written
+            view = view[written:]
+        self.manifest.advance(self.index, offset)
+
+
+class RangeNotSupported(Exception):
+    """ Server answered a byte-range request with the whole file """
+
+
+class SegmentManifest(object):
+    """ Completed byte offsets of a segmented download, kept next to its partial file """
+    def __init__(self, path, file_size, segments):
+        self.path = path
+        self.file_size = file_size
+        self.segments = segments
+        self.lock = threading.Lock()
+        self.saved_at = 0
+
+    @classmethod
+    def create(cls, path, file_size, count):
+        step = -(-file_size // count)
+        segments = [[lo, lo, min(lo + step, file_size) - 1]
+                    for lo in range(0, file_size, step)]
+        return cls(path, file_size, segments)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return cls(path, int(data['size']),
+                       [[int(lo), int(offset), int(end)] for lo, offset, end in data['segments']])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def describes(self, tmp_scene_path):
+        """ Whether tmp_scene_path is the preallocated file this manifest tracks """
+        return (os.path.exists(tmp_scene_path)
+                and os.path.getsize(tmp_scene_path) == self.file_size)
+
+    def pending(self):
+        return [i for i, (_, offset, end) in enumerate(self.segments) if offset <= end]
+
+    def advance(self, index, offset):
+        with self.lock:
+            self.segments[index][1] = offset
+            if time.time() - self.saved_at >= MANIFEST_SAVE_INTERVAL:
+                self._write()
+
+    def save(self):
+        with self.lock:
+            self._write()
+
+    def _write(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'size': self.file_size, 'segments': self.segments}, f)
+        os.rename(tmp_path, self.path)
+        self.saved_at = time.time()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 
 class HTTPSHandler(object):
@@ -61,8 +280,13 @@ class HTTPSHandler(object):
         else:
             self.context = SSLContext(PROTOCOL_TLSv1_2)
 
-    def __init__(self, host=''):
+    def close(self):
+        pass
+
+    def __init__(self, host='', chunk_size=DEFAULT_CHUNK_SIZE):
         self.host = host
+        self.chunk_size = chunk_size
+        self.cancelled = threading.Event()
         self._set_ssl_context()
         self.handler = ul.HTTPSHandler(context=self.context)
         self.opener = ul.build_opener(self.handler)
@@ -80,33 +304,52 @@ class HTTPSHandler(object):
         body = (json.dumps(data) if data else '').encode('ascii')
         request = ul.Request(self.host + uri)
         request.get_method = lambda: 'GET'
-        response = self.opener.open(request, data=body)
-        return json.loads(response.read().decode())
+        response = self.opener.open(request, data=body, timeout=TIMEOUT[1])
+        return json_loads(response.read())
 
-    def _download_bytes(self, full_url, first_byte, tmp_scene_path):
+    def fetch(self, uri, max_bytes):
+        request = ul.Request(self.host + uri)
+        request.headers['Range'] = 'bytes=0-{}'.format(max_bytes - 1)
+        response = self.opener.open(request, timeout=TIMEOUT[1])
+        # A ranged reply gives the full size; otherwise one byte more than
+        # allowed tells a larger file apart from one of exactly max_bytes
+        content_range = response.headers.get('Content-Range', '')
+        content = response.read(max_bytes + 1)
+        response.close()
+        if len(content) > max_bytes or ('/' in content_range and
+                                        int(content_range.rsplit('/', 1)[-1]) > max_bytes):
+            raise IOError('%s is larger than %d bytes' % (uri, max_bytes))
+        return content
+
+    def _download_bytes(self, full_url, first_byte, tmp_scene_path, hasher=None):
         request = ul.Request(full_url)
         request.headers['Range'] = 'bytes={}-'.format(first_byte)
 
-        with open(tmp_scene_path, 'ab') as target:
-            source = self.opener.open(request)
-            shutil.copyfileobj(source, target)
+        with open(tmp_scene_path, 'ab', self.chunk_size) as target:
+            fadvise(target.fileno(), 'POSIX_FADV_SEQUENTIAL')
+            source = self.opener.open(request, timeout=TIMEOUT[1])
+            target = HashingWriter(target, hasher, self.cancelled)
+            shutil.copyfileobj(source, target, self.chunk_size)
 
         return os.path.getsize(tmp_scene_path)
 
-    def download(self, uri, target_path, verbose=False):
+    def download(self, uri, target_path, verbose=False, hasher=None):
         request = ul.Request(self.host + uri)
         request.get_method = lambda: 'HEAD'
 
-        head = self.opener.open(request)
+        head = self.opener.open(request, timeout=TIMEOUT[1])
 
         file_size = int(head.headers['Content-Length'])
 
         first_byte, tmp_scene_path = 0, target_path + '.part'
         if os.path.exists(tmp_scene_path):
             first_byte = os.path.getsize(tmp_scene_path)
+            if hasher is not None:
+                hash_file(tmp_scene_path, hasher)
 
         while first_byte < file_size:
-            first_byte = self._download_bytes(self.host + uri, first_byte, tmp_scene_path)
+            first_byte = self._download_bytes(self.host + uri, first_byte, tmp_scene_path,
+                                              hasher)
 
         if first_byte >= file_size:
             os.rename(tmp_scene_path, target_path)
@@ -115,56 +358,241 @@ class HTTPSHandler(object):
 
 class RequestsHandler(object):
 
-    def __init__(self, host=''):
+    def __init__(self, host='', segments=1, pool_size=10, chunk_size=DEFAULT_CHUNK_SIZE):
         self.host = host
-        self.creds = None
-        self.headers = {}
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.cancelled = threading.Event()
+        # One connection pool per handler, so every request after the first
+        # skips the TCP and TLS handshakes
+        self.session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1,
+                        status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def auth(self, username, password):
-        basic = ('%s:%s' % (username, password)).encode('ascii')
-        self.creds = (username, password)
-        self.headers = {
-                'User-Agent': USERAGENT + ' (Requests/%s)' % requests.__version__
-        }
+        self.session.auth = (username, password)
+        self.session.headers['User-Agent'] = \
+            USERAGENT + ' (Requests/%s)' % requests.__version__
+
+    def close(self):
+        self.session.close()
 
     def get(self, uri, data=None):
-        response = requests.get(self.host+uri, json=data,
-                                headers=self.headers, auth=self.creds)
+        response = self.session.get(self.host+uri, json=data, timeout=TIMEOUT)
         response.raise_for_status()
-        results = response.json()
+        results = json_loads(response.content)
         return results
 
-    def download(self, uri, target_path, verbose=False):
-        fileurl = self.host + uri
+    def fetch(self, uri, max_bytes):
+        """
+        Read a small file into memory with one ranged GET, skipping the .part file
 
-        head = requests.head(fileurl)
+        args:
+            uri - file to read
+            max_bytes - largest size the file is expected to have
 
+        returns:
+            the file contents as bytes
+        """
+        headers = {'Range': 'bytes=0-%d' % (max_bytes - 1), 'Accept-Encoding': 'identity'}
+        response = self.session.get(self.host + uri, headers=headers, timeout=TIMEOUT)
+        response.raise_for_status()
+        # The size headers of a compressed reply count encoded bytes, not the file's
         file_size = None
-        if 'Content-Length' in head.headers:
-            file_size = int(head.headers['Content-Length'])
-
-        first_byte, tmp_scene_path = 0, target_path + '.part'
+        if 'Content-Encoding' not in response.headers:
+            file_size = content_size(response)
+        if len(response.content) > max_bytes or (file_size is not None and
+                                                 file_size > len(response.content)):
+            raise IOError('%s is larger than %d bytes' % (uri, max_bytes))
+        return response.content
+
+    def download(self, uri, target_path, verbose=False, hasher=None):
+        fileurl = self.host + uri
+        # Appended downloads and preallocated ones written in place use
+        # different partial files: only the former show progress by their size
+        tmp_scene_path = target_path + '.part'
+        segments_path = target_path + '.segments.part'
+        manifest_path = segments_path + '.manifest'
+
+        manifest = SegmentManifest.load(manifest_path)
+        if manifest is None or not manifest.describes(segments_path):
+            for path in (manifest_path, segments_path):
+                if os.path.exists(path):
+                    # Unreadable, or its partial file is gone or was replaced:
+                    # the offsets cannot be trusted, so start the file again
+                    LOGGER.debug('Discarding stale %s', path)
+                    os.remove(path)
+            manifest = None
+        if manifest is not None:
+            try:
+                self._download_segments(fileurl, manifest, segments_path, hasher)
+            except RangeNotSupported:
+                LOGGER.debug('Byte ranges not honoured for %s, using one stream', fileurl)
+                # A file written in segments cannot be resumed by appending to it
+                os.remove(segments_path)
+                manifest.remove()
+            else:
+                os.rename(segments_path, target_path)
+                manifest.remove()
+                return target_path
+
+        first_byte = 0
         if os.path.exists(tmp_scene_path):
             first_byte = os.path.getsize(tmp_scene_path)
 
-        self.headers.update({'Range': 'bytes=%d-' % first_byte})
-        sock = requests.get(fileurl, headers=self.headers, stream=True)
-
-        f = open(tmp_scene_path, 'ab')
-        bytes_in_mb = 1024*1024
-        for block in sock.iter_content(chunk_size=bytes_in_mb):
-            if block:
-                f.write(block)
-        f.close()
-
-        if os.path.getsize(tmp_scene_path) >= file_size:
+        # The file size comes from this response's Content-Range, not a separate HEAD.
+        # Byte offsets only mean something if the body is not compressed in transit
+        headers = {'Range': 'bytes=%d-' % first_byte, 'Accept-Encoding': 'identity'}
+        sock = self.session.get(fileurl, headers=headers, stream=True, timeout=TIMEOUT)
+        if sock.status_code == 416 and first_byte and first_byte == content_size(sock):
+            # An earlier run appended every byte but stopped before renaming
+            sock.close()
+            if hasher is not None:
+                hash_file(tmp_scene_path, hasher)
+            os.rename(tmp_scene_path, target_path)
+            return target_path
+        sock.raise_for_status()
+        file_size = content_size(sock, first_byte)
+
+        if (sock.status_code == 206 and first_byte == 0 and file_size
+                and file_size >= MIN_SEGMENT_SIZE and hasattr(os, 'pwrite')):
+            # Large files are preallocated and written in place, even as a
+            # single segment, which needs the manifest to track progress
+            count = max(1, min(self.segments, file_size // MIN_SEGMENT_SIZE))
+            manifest = SegmentManifest.create(manifest_path, file_size, count)
+            manifest.save()
+            self._download_segments(fileurl, manifest, segments_path, hasher, sock)
+            os.rename(segments_path, target_path)
+            manifest.remove()
+            return target_path
+
+        if sock.status_code == 206 and first_byte and hasher is not None:
+            hash_file(tmp_scene_path, hasher)
+
+        sock.raw.decode_content = True
+        # Without a 206 the server is sending the whole file again
+        mode = 'ab' if sock.status_code == 206 else 'wb'
+        with open(tmp_scene_path, mode, self.chunk_size) as target:
+            fadvise(target.fileno(), 'POSIX_FADV_SEQUENTIAL')
+            target = HashingWriter(target, hasher, self.cancelled)
+            shutil.copyfileobj(sock.raw, target, self.chunk_size)
+
+        if file_size is None or os.path.getsize(tmp_scene_path) >= file_size:
             os.rename(tmp_scene_path, target_path)
         return target_path
 
+    def _download_segments(self, fileurl, manifest, tmp_scene_path, hasher=None, sock=None):
+        """
+        Fetch a file as one or more concurrent byte ranges written in place
+
+        args:
+            fileurl - URL of the file to fetch
+            manifest - SegmentManifest of the ranges still to fetch
+            tmp_scene_path - partial file the ranges are written into
+            hasher - updated with the whole file's contents
+            sock - open response already streaming the first pending range
+
+        raises:
+            RangeNotSupported - the server ignored the Range header
+        """
+        fd = os.open(tmp_scene_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, manifest.file_size)
+            except (AttributeError, OSError) as exc:
+                LOGGER.debug('Could not preallocate %s (%s)', tmp_scene_path, exc)
+                # Still give the file its full (sparse) size, which is how a
+                # later run recognises it as belonging to the manifest
+                os.ftruncate(fd, manifest.file_size)
+
+            pending = manifest.pending()
+            # The first segment arrives in order from the start of the file, so
+            # it is hashed on the way in and only the rest is read back
+            streamed = hasher is not None and 0 in pending
+            if pending:
+                with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                    # Every range is confirmed before a byte is hashed, so a
+                    # server refusing one leaves the hasher clean for the fallback
+                    socks = self._open_segments(pool, fileurl, manifest, pending, sock)
+                    if streamed:
+                        hash_file(tmp_scene_path, hasher, manifest.segments[0][1])
+                    futures = [pool.submit(self._download_segment, fileurl, fd, manifest, i,
+                                           hasher if streamed and i == 0 else None, socks[i])
+                               for i in pending]
+                    for future in futures:
+                        future.result()
+        finally:
+            os.close(fd)
+
+        if streamed:
+            hash_file(tmp_scene_path, hasher, offset=manifest.segments[0][2] + 1)
+        elif hasher is not None:
+            hash_file(tmp_scene_path, hasher)
+
+    def _open_segments(self, pool, fileurl, manifest, pending, sock=None):
+        """
+        Start a response for each pending segment at the same time
+
+        args:
+            pool - executor the requests are sent from
+            fileurl - URL of the file to fetch
+            manifest - SegmentManifest the segments belong to
+            pending - indexes of the segments to open
+            sock - open response already streaming the first pending segment
+
+        returns:
+            dict of segment index to its open response
+        """
+        opening = dict((i, pool.submit(self._open_segment, fileurl, manifest, i))
+                       for i in pending if sock is None or i != pending[0])
+        wait(opening.values())
+        socks = dict((i, future.result()) for i, future in opening.items()
+                     if future.exception() is None)
+        if sock is not None:
+            socks[pending[0]] = sock
+        if len(socks) < len(pending):
+            for open_sock in socks.values():
+                open_sock.close()
+            # Raises the first failure, such as RangeNotSupported
+            for future in opening.values():
+                future.result()
+        return socks
+
+    def _open_segment(self, fileurl, manifest, index):
+        _, offset, end = manifest.segments[index]
+        headers = {'Range': 'bytes=%d-%d' % (offset, end), 'Accept-Encoding': 'identity'}
+        sock = self.session.get(fileurl, headers=headers, stream=True, timeout=TIMEOUT)
+        sock.raise_for_status()
+        if sock.status_code != 206:
+            sock.close()
+            raise RangeNotSupported(fileurl)
+        return sock
+
+    def _download_segment(self, fileurl, fd, manifest, index, hasher=None, sock=None):
+        _, offset, end = manifest.segments[index]
+        if sock is None:
+            sock = self._open_segment(fileurl, manifest, index)
+
+        sock.raw.decode_content = True
+        target = SegmentWriter(fd, manifest, index, hasher, self.cancelled)
+        try:
+            # An open-ended response may run past this segment's end
+            copy_bytes(sock.raw, target, end + 1 - offset, self.chunk_size)
+        finally:
+            sock.close()
+            manifest.save()
+        offset = manifest.segments[index][1]
+        if offset <= end:
+            raise IOError('Connection closed at byte %d of range ending %d' % (offset, end))
+
 class Api(object):
     def __init__(self, username, password, host):
         if requests:
-            self.handler = RequestsHandler(host)
+            self.handler = RequestsHandler(host, pool_size=METADATA_CONCURRENCY)
         else:
             self.handler = HTTPSHandler(host)
         self.handler.auth(username, password)
@@ -182,7 +610,7 @@ class Api(object):
         """
         resp = self.handler.get(endpoint, data)
         if isinstance(resp, dict):
-            messages = resp.pop('messages', dict())
+            messages = resp.get('messages', dict())
             if messages.get('errors'):
                 raise Exception('{}'.format(messages.get('errors')))
             if messages.get('warnings'):
@@ -209,46 +637,79 @@ class Api(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self.handler.close()
 
 
 class Scene(object):
+    __slots__ = ('srcurl', 'orderid', 'filename', 'name')
 
     def __init__(self, srcurl):
         self.srcurl = srcurl
 
-        parts = self.srcurl.split("/")
-        self.orderid = parts[4]
+        # e.g. /orders/<orderid>/<filename>
+        parts = urlsplit(srcurl).path.split('/')
+        self.orderid = parts[2]
         self.filename = parts[-1]
-        self.name = self.filename.split('.tar.gz')[0]
+        if self.filename.endswith('.tar.gz'):
+            self.name = self.filename[:-len('.tar.gz')]
+        else:
+            self.name = self.filename
 
-    @classmethod
-    def checksum(cls):
-        cls.srcurl = str(cls.srcurl).replace('.tar.gz', '.md5')
-        cls.filename = cls.filename.replace('.tar.gz', '.md5')
-        cls.name = '%s MD5 checksum' % cls.name
-        return cls
+    def checksum(self):
+        checksum = Scene(self.srcurl.replace('.tar.gz', '.md5'))
+        checksum.name = '%s MD5 checksum' % self.name
+        return checksum
 
 
 class LocalStorage(object):
 
-    def __init__(self, basedir, no_order_directories=False, verbose=False):
+    def __init__(self, basedir, no_order_directories=False, verbose=False, segments=1,
+                 concurrency=1, chunk_size=DEFAULT_CHUNK_SIZE):
         self.basedir = basedir
         self.no_order_directories = no_order_directories
         self.verbose = verbose
+        # Directories known to exist, by order id
+        self._dir_cache = {}
+        # Directory contents at startup, by path
+        self._listings = {}
         if requests:
-            self.handler = RequestsHandler()
+            # Room for the checksum prefetches running alongside the downloads
+            pool_size = 2 * concurrency * segments
+            self.handler = RequestsHandler(segments=segments, pool_size=pool_size,
+                                           chunk_size=chunk_size)
         else:
-            self.handler = HTTPSHandler()
+            self.handler = HTTPSHandler(chunk_size=chunk_size)
+
+    def close(self):
+        self.handler.close()
+
+    def cancel(self):
+        """ Make downloads in progress stop at their next block """
+        self.handler.cancelled.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def directory_path(self, scene):
+        key = None if self.no_order_directories else scene.orderid
+        if key in self._dir_cache:
+            return self._dir_cache[key]
+
         if self.no_order_directories:
             path = self.basedir
         else:
             path = os.path.join(self.basedir, scene.orderid)
-        if not os.path.exists(path):
+        try:
             os.makedirs(path)
             LOGGER.debug("Created target_directory: %s " % path)
+        except OSError as exc:
+            # Already there, possibly just made by another worker
+            if exc.errno != errno.EEXIST or not os.path.isdir(path):
+                raise
+        self._dir_cache[key] = path
         return path
 
     def scene_path(self, scene):
@@ -257,26 +718,103 @@ class LocalStorage(object):
     def is_stored(self, scene):
         return os.path.exists(self.scene_path(scene))
 
-    def store(self, scene, checksum=False, retry=0):
-        if self.is_stored(scene):
+    def is_complete(self, scene, checksum=False):
+        """ Whether a scene (and its checksum file) were stored by an earlier run """
+        path = self.directory_path(scene)
+        if path not in self._listings:
+            self._listings[path] = set(os.listdir(path))
+        names = self._listings[path]
+        return scene.filename in names and (not checksum or scene.checksum().filename in names)
+
+    def _compare_checksum(self, scene, checksum_scene, hasher=None):
+        with open(self.scene_path(checksum_scene)) as f:
+            remote_md5hash = (f.read().split() or [''])[0].lower()
+        if hasher is None:
+            hasher = hash_file(self.scene_path(scene))
+        local_md5hash = hasher.hexdigest()
+        if local_md5hash != remote_md5hash:
+            LOGGER.warning('Checksum mismatch for %s (local %s, remote %s)',
+                           scene.filename, local_md5hash, remote_md5hash)
+        else:
+            LOGGER.debug('Checksum verified for %s', scene.filename)
+
+    def store_checksum(self, scene):
+        checksum_scene = scene.checksum()
+        if not self.is_stored(checksum_scene):
+            content = self.handler.fetch(checksum_scene.srcurl, CHECKSUM_MAX_BYTES)
+            target_path = self.scene_path(checksum_scene)
+            with open(target_path + '.part', 'wb') as f:
+                f.write(content)
+            os.rename(target_path + '.part', target_path)
+
+    def store(self, scene, checksum=False, retry=0, prefetch=None):
+        """
+        Download a scene, and with checksum its MD5 file, then verify the two
+
+        args:
+            prefetch - future of a store_checksum already running for this
+                       scene; waited on so both never write the same file
+        """
+        checksum_scene = scene.checksum() if checksum else None
+        if self.is_stored(scene) and not checksum:
             LOGGER.debug('Scene already exists on disk, skipping.')
             return
 
         for tries in range(0, retry+1):
             LOGGER.debug("Downloading %s, to: %s" % (scene.name, self.directory_path(scene)))
             try:
-                self.handler.download(scene.srcurl, self.scene_path(scene), self.verbose)
+                # Hashed as the bytes arrive, so verifying needs no second read
+                hasher = None
+                if not self.is_stored(scene):
+                    hasher = new_md5() if checksum else None
+                    self.handler.download(scene.srcurl, self.scene_path(scene), self.verbose,
+                                          hasher)
                 if checksum:
-                    scene = scene.checksum()
-                    self.handler.download(scene.srcurl, self.scene_path(scene), self.verbose)
+                    if prefetch is not None:
+                        # A failed prefetch is simply fetched again below
+                        wait([prefetch])
+                        prefetch = None
+                    self.store_checksum(scene)
+                    self._compare_checksum(scene, checksum_scene, hasher)
+                drop_page_cache(self.scene_path(scene))
                 return
             except Exception as exc:
+                if self.handler.cancelled.is_set():
+                    raise
                 LOGGER.error('Scene not reachable at %s (%s)', scene.srcurl, exc)
-                time.sleep(random.randint(2, 30))
+                if tries == retry:
+                    raise
+                if self.handler.cancelled.wait(backoff_delay(tries)):
+                    raise DownloadCancelled(scene.srcurl)
+
+
+def produce_scenes(api, orders, batches):
+    """
+    Queue (order, scene URLs) for each order as soon as its status arrives
+
+    args:
+        api - Api used to list each order's completed scenes
+        orders - order ids to list
+        batches - queue.Queue receiving the results, then None when done; an
+                  exception instead of URLs means listing failed
+    """
+    try:
+        if orders:
+            workers = min(METADATA_CONCURRENCY, len(orders))
+            with ThreadPoolExecutor(max_workers=workers) as metadata_pool:
+                futures = dict((metadata_pool.submit(api.get_completed_scenes, o), o)
+                               for o in orders)
+                for future in as_completed(futures):
+                    batches.put((futures[future], future.result()))
+    except Exception as exc:
+        batches.put((None, exc))
+    finally:
+        batches.put(None)
 
 
 def main(username, email, order, target_directory, password=None, host=None, verbose=False,
-         checksum=False, retry=0, no_order_directories=False):
+         checksum=False, retry=0, no_order_directories=False, concurrency=4, segments=2,
+         chunk_mb=8):
     if not username:
         raise ValueError('Must supply valid username')
     if not password:
@@ -284,26 +822,80 @@ def main(username, email, order, target_directory, password=None, host=None, ver
     if not host:
         host = 'https://espa.cr.usgs.gov'
 
-    storage = LocalStorage(target_directory, no_order_directories)
-
-    with Api(username, password, host) as api:
-        if order == 'ALL':
-            orders = api.retrieve_all_orders(email)
-        else:
-            orders = [order]
-
-        LOGGER.debug('Retrieving orders: {0}'.format(orders))
-
-        for o in orders:
-            scenes = api.get_completed_scenes(o)
-            if len(scenes) < 1:
-                LOGGER.warning('No scenes in "completed" state for order {}'.format(o))
-
-            for s in range(len(scenes)):
-                LOGGER.info('File {0} of {1} for order: {2}'.format(s + 1, len(scenes), o))
+    storage = LocalStorage(target_directory, no_order_directories, segments=segments,
+                           concurrency=concurrency, chunk_size=chunk_mb * 1024 * 1024)
 
-                scene = Scene(scenes[s])
-                storage.store(scene, checksum, retry)
+    # Checksum files are prefetched by as many workers as there are download
+    # streams; the download pool is shut down first since its scenes wait on them
+    with storage, Api(username, password, host) as api, \
+            ThreadPoolExecutor(max_workers=concurrency * segments) as checksum_pool, \
+            ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {}
+        prefetches = []
+        try:
+            if order == 'ALL':
+                orders = api.retrieve_all_orders(email)
+            else:
+                orders = [order]
+
+            LOGGER.debug('Retrieving orders: {0}'.format(orders))
+
+            # Downloads start with the first order's scenes while the rest are still listed
+            batches = queue.Queue(maxsize=64)
+            producer = threading.Thread(target=produce_scenes, args=(api, orders, batches))
+            producer.daemon = True
+            producer.start()
+
+            skipped = 0
+            listing_error = None
+            for o, scenes in iter(batches.get, None):
+                if isinstance(scenes, Exception):
+                    # Scenes already submitted are still waited for below
+                    listing_error = scenes
+                    break
+                if len(scenes) < 1:
+                    LOGGER.warning('No scenes in "completed" state for order {}'.format(o))
+
+                work = []
+                for s in range(len(scenes)):
+                    label = 'File {0} of {1} for order: {2}'.format(s + 1, len(scenes), o)
+                    work.append((Scene(scenes[s]), label))
+
+                # Checked against one directory listing per order, before any request is made
+                pending = [item for item in work if not storage.is_complete(item[0], checksum)]
+                skipped += len(work) - len(pending)
+                work = pending
+
+                # Consecutive requests to the same host pick up its idle pooled connections
+                work.sort(key=lambda item: urlsplit(item[0].srcurl).netloc)
+
+                for scene, label in work:
+                    prefetch = None
+                    if checksum:
+                        prefetch = checksum_pool.submit(storage.store_checksum, scene)
+                        prefetches.append(prefetch)
+                    future = pool.submit(storage.store, scene, checksum, retry, prefetch)
+                    futures[future] = label
+
+            if skipped:
+                LOGGER.info('Skipped {0} scenes already on disk'.format(skipped))
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    LOGGER.info('{0} finished'.format(futures[future]))
+                except Exception as exc:
+                    LOGGER.error('{0} failed ({1})'.format(futures[future], exc))
+
+            if listing_error is not None:
+                raise listing_error
+        except BaseException:
+            # Without this the pool's shutdown would run every queued scene
+            # before an interrupt could end the process
+            storage.cancel()
+            for future in list(futures) + prefetches:
+                future.cancel()
+            raise
 
 
 if __name__ == '__main__':
@@ -374,6 +966,27 @@ if __name__ == '__main__':
                         action='store_true',
                         help='disable generation of order-prefixed directories')
 
+    parser.add_argument('-t', '--concurrency',
+                        required=False,
+                        type=int,
+                        choices=range(1, 9),
+                        default=4,
+                        help='number of scenes to download at the same time')
+
+    parser.add_argument('-s', '--segments',
+                        required=False,
+                        type=int,
+                        choices=range(1, 9),
+                        default=2,
+                        help='number of byte ranges to fetch concurrently for each large file')
+
+    parser.add_argument('-b', '--chunk-mb',
+                        required=False,
+                        type=int,
+                        choices=range(1, 65),
+                        metavar='{1-64}',
+                        default=8,
+                        help='size in MiB of each read from the network')
 
     parsed_args = parser.parse_args()
 
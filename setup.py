@@ -33,6 +33,7 @@ setup(
     # Dependent packages (distributions)
     install_requires=[
         'requests',
+        'futures; python_version < "3"',
         ],
 
     # Supported Python versions